@@ -225,6 +225,7 @@ class Application:
     def __exit__(self, typ, value, tb):
         with self.lock: self.stop = True
         self.builder.join()
+        if (st := self.apps.get('*store')) is not None: st.close()
 
     def watch_and_build(self):
         self.remove_all()
@@ -401,6 +402,7 @@ Release notes: <https://t-doc.org/common/release-notes.html#release-%s>
         if (method := env['REQUEST_METHOD']) not in (HTTPMethod.HEAD,
                                                      HTTPMethod.GET):
             yield from wsgi.error(respond, HTTPStatus.NOT_IMPLEMENTED)
+            return
         t = None
         for k, v in parse.parse_qsl(env.get('QUERY_STRING', '')):
             if k == 't':
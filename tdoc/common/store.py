@@ -1,10 +1,12 @@
 # Copyright 2024 Remy Blank <remy@c-space.org>
 # SPDX-License-Identifier: MIT
 
+import collections
+from concurrent import futures
 import contextlib
 from http import HTTPMethod, HTTPStatus
-import json
 import pathlib
+import queue
 import sqlite3
 import threading
 import time
@@ -13,39 +15,169 @@ from wsgiref import util
 from . import wsgi
 
 
-class ThreadLocal(threading.local):
-    def __init__(self, **kwargs):
-        super().__init__()
-        self.__dict__.update(kwargs)
+def optimize(db):
+    """Let SQLite refresh the query planner statistics if needed."""
+    try:
+        db.execute('pragma optimize')
+        db.commit()
+    except sqlite3.Error:
+        db.rollback()  # The statistics are only an optimization
+
+
+class Closed(Exception):
+    """Raised when using a store that has been closed."""
+
+
+class Pool:
+    """A bounded pool of database connections."""
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = []
+        self.waiters = collections.deque()
+        self.count = 0
+        self.closed = False
+
+    def get(self, timeout=None):
+        """Get a connection, creating it if the pool isn't full yet."""
+        # list.pop() is atomic, so idle connections can be taken without
+        # locking. Connections are only added to idle when nobody is waiting.
+        with contextlib.suppress(IndexError):
+            return self.idle.pop()
+        with self.lock:
+            with contextlib.suppress(IndexError):
+                return self.idle.pop()
+            if self.count < self.size:
+                self.count += 1
+                waiter = None
+            else:
+                waiter = futures.Future()
+                self.waiters.append(waiter)
+        if waiter is not None:
+            # Released connections are handed over directly to the oldest
+            # waiter, so they can't be taken by a newer caller in between. A
+            # result of None hands over the right to create a connection.
+            try:
+                db = waiter.result(timeout)
+            except TimeoutError:
+                with self.lock:
+                    if not waiter.done():
+                        self.waiters.remove(waiter)
+                        raise TimeoutError(
+                            "Timeout waiting for a database connection")
+                db = waiter.result()
+            if db is not None: return db
+        try:
+            return self.connect()
+        except BaseException:
+            with self.lock:
+                if self.waiters:
+                    self.waiters.popleft().set_result(None)
+                else:
+                    self.count -= 1
+            raise
+
+    def release(self, db):
+        """Return a connection obtained from get() to the pool."""
+        with self.lock:
+            if self.waiters:
+                self.waiters.popleft().set_result(db)
+                return
+            if not self.closed:
+                self.idle.append(db)
+                return
+            self.count -= 1
+        db.close()
+
+    def close(self):
+        """Close all idle connections, and close others on release."""
+        idle = []
+        with self.lock:
+            self.closed = True
+            with contextlib.suppress(IndexError):
+                while True: idle.append(self.idle.pop())
+            self.count -= len(idle)
+        for db in idle: db.close()
 
 
 class Store:
-    thread_local = ThreadLocal(db=None)
+    log_batch_size = 500
+    log_queue_size = 5000
+    optimize_interval = 3600
+    perms_cache_size = 4096
+    perms_cache_ttl = 30
 
-    def __init__(self, path):
+    def __init__(self, path, pool_size=16):
         self.path = pathlib.Path(path).absolute()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.log_queue = None
+        self.log_writer = None
+        self.log_db = None
+        self.perms_cache = {}
+        self.endpoints = {'log': self.handle_log}
+        # In WAL mode, readers don't block writers and vice versa. Request
+        # threads only read, through a pool of read-only connections. All
+        # writes go through the log writer thread, which owns the only
+        # read-write connection.
+        self.read_pool = Pool(
+            lambda: self._connect('ro', autocommit=True,
+                                  check_same_thread=False), pool_size)
+
+    def close(self):
+        """Stop the log writer, and close all database connections."""
+        with self.lock:
+            self.closed = True
+            writer, self.log_writer = self.log_writer, None
+        if writer is not None:
+            # Entries queued before the sentinel are still committed.
+            self.log_queue.put(None)
+            writer.join()
+        if (db := self.log_db) is not None:
+            self.log_db = None
+            optimize(db)
+            db.close()
+        self.read_pool.close()
 
-    def _connect(self, params, timeout=10, autocommit=False):
-        return sqlite3.connect(f'{self.path.as_uri()}?{params}', uri=True,
-                               timeout=timeout, autocommit=autocommit,
-                               check_same_thread=True)
+    def _connect(self, mode, autocommit=False, check_same_thread=True):
+        db = sqlite3.connect(f'{self.path.as_uri()}?mode={mode}', uri=True,
+                             timeout=10, autocommit=True,
+                             check_same_thread=check_same_thread)
+        try:
+            # synchronous=normal is safe in WAL mode: a power loss can only
+            # roll back the latest transactions, not corrupt the database.
+            db.executescript("""
+                pragma synchronous = normal;
+                pragma cache_size = -16000;
+                pragma mmap_size = 268435456;
+                pragma temp_store = memory;
+            """)
+            # Read-only connections cannot store statistics.
+            if mode != 'ro': db.execute('pragma optimize = 0x10002')
+            db.autocommit = autocommit
+            return db
+        except BaseException:
+            db.close()
+            raise
 
     @contextlib.contextmanager
-    def transaction(self, env):
-        if (db := self.thread_local.db) is None:
-            self.thread_local.db = db = self._connect(
-                'mode=rw', timeout=env.get('tdoc.db_timeout', 10))
+    def read_connection(self, env):
+        # Read-only connections are in autocommit mode, so reads don't pay for
+        # an explicit BEGIN / COMMIT.
+        db = self.read_pool.get(timeout=env.get('tdoc.db_timeout', 10))
         try:
             yield db
-            db.commit()
-        except BaseException:
-            db.rollback()
-            raise
+        finally:
+            self.read_pool.release(db)
 
     def create(self, open_acl=False):
-        db = self._connect('mode=rwc', autocommit=True)
+        db = self._connect('rwc', autocommit=True)
         try:
             db.execute('pragma journal_mode=WAL')
+            # Create the schema in a single transaction.
+            db.autocommit = False
             db.executescript("""
                 create table meta (
                     key text primary key,
@@ -72,16 +204,139 @@ class Store:
         finally:
             db.close()
 
-    def check_acl(self, db, token, perm):
-        for perms, in db.execute(
-                "select perms from auth where token in (?, '*')", (token,)):
-            perms = perms.split(',')
-            if perm in perms or '*' in perms: return True
-        return False
+    def log(self, t, location, session, data, timeout=None):
+        """Append an entry to the log, and wait until it has been committed.
+
+        Raises queue.Full if log_queue_size entries are already pending,
+        TimeoutError if the writer doesn't start inserting the entry within
+        timeout seconds, and Closed if the store has been closed. An entry
+        that timed out is dropped.
+        """
+        fut = futures.Future()
+        with self.lock:
+            if self.closed: raise Closed("The store has been closed")
+            if self.log_writer is None:
+                if self.log_queue is None:
+                    self.log_queue = queue.Queue(self.log_queue_size)
+                self.log_writer = threading.Thread(target=self.write_log,
+                                                   daemon=True)
+                self.log_writer.start()
+            # Enqueue under the lock, so that close() can't push its sentinel
+            # in between and leave the entry behind.
+            self.log_queue.put_nowait(((t, location, session, data), fut))
+        try:
+            return fut.result(timeout)
+        except TimeoutError:
+            # Drop the entry if the writer hasn't taken it yet, so that a
+            # client retrying after the error doesn't log it twice. Otherwise,
+            # the outcome of the insert is known soon.
+            if fut.cancel(): raise
+        return fut.result()
+
+    def write_log(self):
+        # Entries are inserted in batches, with one transaction per batch.
+        # Entries queued while a batch is being committed are grouped into the
+        # next one, so the batch size follows the request rate without adding
+        # latency to isolated requests. The data is serialized here rather than
+        # on the request threads. A None entry, pushed by close(), stops the
+        # thread once the entries before it have been committed.
+        done = False
+        while not done:
+            batch = []
+            while len(batch) < self.log_batch_size:
+                try:
+                    item = (self.log_queue.get() if not batch
+                            else self.log_queue.get_nowait())
+                except queue.Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                if item[1].set_running_or_notify_cancel(): batch.append(item)
+            if not batch: continue
+            try:
+                if (db := self.log_db) is None:
+                    # The connection is left open for close() to optimize.
+                    db = self.log_db = self._connect('rw',
+                                                     check_same_thread=False)
+                    next_optimize = time.monotonic() + self.optimize_interval
+                self._insert_log(db, batch)
+                if (now := time.monotonic()) >= next_optimize:
+                    next_optimize = now + self.optimize_interval
+                    optimize(db)
+            except Exception as e:
+                # Fail the pending entries, and reconnect for the next batch.
+                # Closing the connection rolls back the open transaction.
+                for _, fut in batch:
+                    if not fut.done(): fut.set_exception(e)
+                if (db := self.log_db) is not None:
+                    self.log_db = None
+                    db.close()
+
+    def _insert_log(self, db, batch):
+        # Entries that cannot be serialized are rejected individually.
+        rows = []
+        for (t, location, session, data), fut in batch:
+            try:
+                data = wsgi.to_json(data).decode('utf-8')
+            except Exception as e:
+                fut.set_exception(e)
+                continue
+            rows.append(((t, location, session, data), fut))
+        self._insert_rows(db, rows)
+
+    def _insert_rows(self, db, rows):
+        if not rows: return
+        try:
+            db.executemany("""
+                insert into log (time, location, session, data)
+                    values (?, ?, ?, json(?));
+            """, [row for row, _ in rows])
+            db.commit()
+        except (sqlite3.IntegrityError, sqlite3.DataError,
+                sqlite3.ProgrammingError, OverflowError) as e:
+            # Only errors caused by an entry are worth retrying the entries one
+            # by one. Other errors (e.g. a locked database) are raised, and fail
+            # the whole batch.
+            db.rollback()
+            if len(rows) == 1:
+                rows[0][1].set_exception(e)
+                return
+            for row in rows: self._insert_rows(db, [row])
+            return
+        for _, fut in rows: fut.set_result(None)
+
+    def perms(self, env, token):
+        """Return the set of permissions granted to a token.
+
+        The result is cached for perms_cache_ttl seconds, so changes to the
+        auth table can take that long to become effective.
+        """
+        now = time.monotonic()
+        if (entry := self.perms_cache.get(token)) is not None \
+                and now < entry[0]:
+            return entry[1]
+        perms = set()
+        with self.read_connection(env) as db:
+            for p, in db.execute(
+                    "select perms from auth where token in (?, '*')",
+                    (token,)):
+                perms.update(p.split(','))
+        perms = frozenset(perms)
+        with self.lock:
+            self.perms_cache.pop(token, None)
+            self.perms_cache[token] = (now + self.perms_cache_ttl, perms)
+            if len(self.perms_cache) > self.perms_cache_size:
+                del self.perms_cache[next(iter(self.perms_cache))]
+        return perms
+
+    def check_acl(self, env, token, perm):
+        perms = self.perms(env, token)
+        return perm in perms or '*' in perms
 
     def __call__(self, env, respond):
         cmd = util.shift_path_info(env)
-        if (handler := getattr(self, f'handle_{cmd}', None)) is None:
+        if (handler := self.endpoints.get(cmd)) is None:
             return wsgi.error(respond, HTTPStatus.NOT_FOUND)
 
         # Parse the Authorization header if present.
@@ -92,30 +347,31 @@ class Store:
                 return wsgi.error(respond, HTTPStatus.BAD_REQUEST)
             token = parts[1]
 
-        try:
-            with self.transaction(env) as db:
-                if not self.check_acl(db, token, cmd):
-                    return wsgi.error(respond, HTTPStatus.UNAUTHORIZED)
-            return handler(env, respond)
-        finally:
-            if (db := self.thread_local.db) is not None \
-                     and not env.get('tdoc.db_cache_per_thread'):
-                self.thread_local.db = None
-                db.close()
+        if not self.check_acl(env, token, cmd):
+            return wsgi.error(respond, HTTPStatus.UNAUTHORIZED)
+        return handler(env, respond)
 
     def handle_log(self, env, respond):
         method, err = wsgi.method(env, respond, HTTPMethod.POST)
         if err is not None: return err
         if env['PATH_INFO']: return wsgi.error(respond, HTTPStatus.NOT_FOUND)
-        with self.transaction(env) as db:
-            try:
-                req = wsgi.read_json(env)
-            except Exception as e:
-                return wsgi.error(respond, HTTPStatus.BAD_REQUEST)
-            db.execute("""
-                insert into log (time, location, session, data)
-                    values (?, ?, ?, json(?));
-            """, (int(req.get('time', time.time_ns() // 1000000)),
-                  req['location'], req.get('session'),
-                  json.dumps(req['data'], separators=(',', ':'))))
+        try:
+            req = wsgi.read_json(env)
+        except Exception as e:
+            return wsgi.error(respond, HTTPStatus.BAD_REQUEST)
+        # Validate the entry here, so that a bad entry cannot fail a whole batch
+        # on the writer thread.
+        if not isinstance(req, dict) or 'data' not in req:
+            return wsgi.error(respond, HTTPStatus.BAD_REQUEST)
+        if (t := req.get('time')) is None: t = time.time_ns() // 1000000
+        location, session = req.get('location'), req.get('session')
+        if type(t) is not int or not -(1 << 63) <= t < (1 << 63) \
+                or not isinstance(location, str) \
+                or not (session is None or isinstance(session, str)):
+            return wsgi.error(respond, HTTPStatus.BAD_REQUEST)
+        try:
+            self.log(t, location, session, req['data'],
+                     timeout=env.get('tdoc.db_timeout', 10))
+        except (queue.Full, TimeoutError, Closed):
+            return wsgi.error(respond, HTTPStatus.SERVICE_UNAVAILABLE)
         return wsgi.respond_json(respond, {})
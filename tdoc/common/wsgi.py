@@ -1,10 +1,18 @@
 # Copyright 2024 Remy Blank <remy@c-space.org>
 # SPDX-License-Identifier: MIT
 
+import functools
 from http import HTTPStatus
 import json as _json
+import math
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
+
+@functools.cache
 def http_status(status):
     return f'{status} {status.phrase}'
 
@@ -23,13 +31,37 @@ def method(env, respond, *allowed):
     return m, None
 
 
-def read_json(env):
-    data = env['wsgi.input'].read(int(env.get('CONTENT_LENGTH', -1)))
-    return _json.loads(data)
+def to_json(data):
+    """Serialize data to compact JSON, encoded as UTF-8."""
+    if orjson is not None: return orjson.dumps(data)
+    return _json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def _reject_constant(c):
+    raise ValueError(f"Invalid JSON constant: {c}")
+
+
+def _parse_float(s):
+    if math.isinf(f := float(s)): raise ValueError(f"Invalid JSON number: {s}")
+    return f
+
+
+def read_json(env, max_size=1 << 20):
+    # Reading without a known size would block until the client closes the
+    # connection, so a Content-Length is required.
+    size = int(env.get('CONTENT_LENGTH') or -1)
+    if not 0 <= size <= max_size:
+        raise ValueError(f"Invalid request body size: {size}")
+    data = env['wsgi.input'].read(size)
+    if orjson is not None: return orjson.loads(data)
+    # Reject NaN and infinite numbers, like orjson.
+    return _json.loads(data, parse_constant=_reject_constant,
+                       parse_float=_parse_float)
 
 
 def respond_json(respond, data):
-    body = _json.dumps(data, separators=(',', ':')).encode('utf-8')
+    # Most successful API calls respond with an empty object.
+    body = b'{}' if data == {} else to_json(data)
     respond(http_status(HTTPStatus.OK), [
         ('Content-Type', 'application/json'),
         ('Content-Length', str(len(body))),